@@ -1,11 +1,12 @@
 from argparse import ArgumentParser
+from dataclasses import dataclass
 import sys
-from logging import INFO, WARNING, Filter, getLogger, StreamHandler, Formatter, DEBUG
+from logging import WARNING, Filter, getLogger, StreamHandler, Formatter, DEBUG
 import time
 import serial
-from .debugger import OcdRev1
+from .debugger import OcdRev1, ASI_RESET_REQ, ASI_RSTREQ_RESET, ASI_RSTREQ_RUN, ASI_SYS_STATUS, ASI_SYS_SYSRST
 from .rspserver import RspServer
-from .updi import UpdiRev1, UpdiRev3, UpdiException, WIDTH_BYTE, WIDTH_3BYTE, WIDTH_WORD, KEY_OCD, KEY_NVMPROG
+from .updi import UpdiClient, UpdiRev1, UpdiRev3, UpdiException, KEY_NVMPROG
 from .deviceinfo import get_deviceinfo
 
 log = getLogger()
@@ -16,6 +17,37 @@ handler.addFilter(Filter("absurd.rspserver.rspserver"))
 log.setLevel(DEBUG)
 log.addHandler(handler)
 
+@dataclass
+class DeviceIdentity:
+    updiver: int
+    sib: str
+    signature: bytes
+    revid: int
+
+def identify(uc: UpdiClient, signature_addr: int) -> DeviceIdentity:
+    """
+    Connects and identifies the chip: UPDI revision, SIB, signature and revision ID.
+    The chip is reset in NVM programming mode for this, so the caller has to reset it again and disconnect afterwards.
+    """
+    try:
+        updiver: int = uc.connect()
+    except UpdiException:
+        uc.resynchronize()
+        updiver: int = uc.connect()
+
+    time.sleep(0.1)
+    sib: str = uc.read_sib().decode(errors="replace")
+    # key and reset request/release need no response, so they leave in one write
+    with uc.pipeline():
+        uc.key(KEY_NVMPROG)
+        uc.store_csr(ASI_RESET_REQ, ASI_RSTREQ_RESET)
+        uc.store_csr(ASI_RESET_REQ, ASI_RSTREQ_RUN)
+    if not uc.wait_csr(ASI_SYS_STATUS, ASI_SYS_SYSRST, 0):
+        log.warning("Chip did not leave reset in time")
+    signature = uc.load_burst(signature_addr, burst=3)
+    revid = uc.load_direct(0x0F01)              # SYSCFG.REVID
+    return DeviceIdentity(updiver, sib, signature, revid)
+
 
 def main():
     parser = ArgumentParser(description="AVR Basic SerialUPDI Remote Debugger")
@@ -39,35 +71,24 @@ def main():
     uc = UpdiRev1(args.port, args.bps)
     try:
         # Identify the chip and determine UPDI, NVM & OCD versions
-        try:
-            updiver: int = uc.connect()
-        except UpdiException:
-            uc.resynchronize()
-            updiver: int = uc.connect()
-
-        time.sleep(0.1)
-        sib: str = uc.read_sib().decode(errors="replace")
-        uc.key(KEY_NVMPROG)
-        uc.store_csr(0x8, 0x59)
-        uc.store_csr(0x8, 0x00)
-        time.sleep(0.1)
-        signature = uc.load_burst(devinfo.signature_addr, burst=3)
-        revid = uc.load_direct(0x0F01)              # SYSCFG.REVID
+        identity = identify(uc, devinfo.signature_addr)
+        sib = identity.sib
+        revid = identity.revid
         
-        sig = signature.hex("-").upper()
+        sig = identity.signature.hex("-").upper()
         rev = f"{chr((revid>>4)+64)}{revid&0x0F}" if revid & 0xF0 else chr(revid + 64)
         nvmver = sib[10]
         ocdver = sib[13]
-        sibrev = sib[20:22]
 
-        print(f"UPDI rev.{updiver}")
+        print(f"UPDI rev.{identity.updiver}")
         print(f"SIB: {sib}")
         print(f"Signature: {sig} (revision {rev})")
         print(f"NVM: v{nvmver} / OCD: v{ocdver}")
         
-        uc.store_csr(0x8, 0x59)
-        uc.store_csr(0x8, 0x00)
-        time.sleep(0.1)
+        with uc.pipeline():
+            uc.store_csr(ASI_RESET_REQ, ASI_RSTREQ_RESET)
+            uc.store_csr(ASI_RESET_REQ, ASI_RSTREQ_RUN)
+        uc.wait_csr(ASI_SYS_STATUS, ASI_SYS_SYSRST, 0)
         uc.disconnect()
 
     except serial.SerialException:
@@ -80,6 +101,7 @@ def main():
         exit(1)
     
     # main loop
+    # The session has to be closed in between, as disabling UPDI is what takes the chip out of programming mode
     updic = UpdiRev3(args.port, args.bps, updi_prescaler=0)
     try:
         dbg = OcdRev1(updic, flash_offset=devinfo.flash_offset)
@@ -1,7 +1,10 @@
 from enum import IntEnum, IntFlag
+import struct
 import time
-from typing import Optional
-from ..updi import WIDTH_BYTE, WIDTH_WORD, UpdiClient, UpdiException, KEY_OCD
+from typing import Optional, Tuple
+from logging import getLogger
+from ..updi import WIDTH_BYTE, WIDTH_WORD, UpdiClient, UpdiException, KEY_OCD, UPDI_CTRLA
+log = getLogger(__name__)
 
 OCD = 0x0F80
 OCD_BP0A = OCD + 0x00
@@ -17,8 +20,14 @@ OCD_SP = OCD + 0x18
 OCD_SREG = OCD + 0x1C
 OCD_R0 = OCD + 0x20
 
+# BP0A, BP0AT, BP1A, BP1AT, TRAPEN, CAUSE, PC, SP, SREG as laid out from OCD_BP0A onwards
+OCD_DUMP = struct.Struct("<HBxHBxHxxH6xH2xH2xB")
+# PC, SP and SREG as laid out from OCD_PC up to OCD_R0
+OCD_CPU = struct.Struct("<H2xH2xB3x")
+# BPnA and BPnAT are adjacent and are written together
+OCD_BP = struct.Struct("<HB")
+
 # UPDI CSR addresses
-UPDI_CTRLA = 0x2
 ASI_OCD_CTRLA = 0x4
 ASI_OCD_STATUS = 0x5
 ASI_RESET_REQ = 0x8
@@ -45,10 +54,25 @@ class Traps(IntFlag):
     JMP = 0x4000
     INT = 0x8000
 
+def flag_strings(flags: str, absent: str) -> tuple:
+    """
+    Renders every byte value as one character per bit, MSB first:
+    the character from `flags` where the bit is set, the one from `absent` where it is clear.
+    Bits marked with a space in `flags` are left out.
+    """
+    return tuple("".join(flags[i] if value & (0x80 >> i) else absent[i] for i in range(8) if flags[i] != " ")
+                 for value in range(256))
+
+SREG_FLAGS = flag_strings("ITHSVNZC", "ithsvnzc")
+TRAPENH_FLAGS = flag_strings("IJSX  10", "________")
+TRAPENL_FLAGS = flag_strings("     PH?", "________")
+
 class OcdRev1:
     def __init__(self, updi: UpdiClient, flash_offset: int) -> None:
         self.updi = updi
         self.flash_offset = flash_offset
+        # Write-through copy of OCD_TRAPEN, read from the device the first time it is needed
+        self.trapen: Optional[int] = None
     
     def attach(self):
         try:
@@ -57,76 +81,96 @@ class OcdRev1:
             # UPDI may already be active: try to resynchronize and it's ok if it succeeds
             self.updi.resynchronize()
 
+        self.trapen = None
         self.updi.key(KEY_OCD)
         # Choose minimum guard time since contention is not destructive on an open-drain bus
         self.updi.store_csr(UPDI_CTRLA, UPDI_CTRLA_GTVAL_2CYCLES)
     
     def detach(self):
+        # Only the cached TRAPEN is consulted: detach runs during teardown, possibly after the link failed
+        if self.trapen is not None and self.trapen & Traps.STEP:
+            try:
+                self.disable_traps(Traps.STEP)
+            except UpdiException as ex:
+                log.warning("Could not clear STEP before detaching: %s", ex)
+        self.trapen = None
         self.updi.disconnect()
     
     def halt(self):
         self.updi.store_csr(ASI_OCD_CTRLA, ASI_OCD_STOP)
 
     def run(self):
-        self.updi.store_csr(ASI_OCD_CTRLA, ASI_OCD_RUN)
+        # step() leaves STEP enabled for the next step; it has to be cleared before running freely
+        with self.updi.pipeline():
+            if self.get_traps() & Traps.STEP:
+                self.disable_traps(Traps.STEP)
+            self.updi.store_csr(ASI_OCD_CTRLA, ASI_OCD_RUN)
     
     def is_halted(self):
-        return (self.updi.load_csr(ASI_OCD_STATUS) & ASI_OCD_STOPPED) or self.updi.load_direct(OCD_CAUSE) #(self.updi.load_direct(OCD_CAUSE) & 0x04)
+        # a single CSR read per poll
+        return bool(self.updi.load_csr(ASI_OCD_STATUS) & ASI_OCD_STOPPED)
 
     def poll_halted(self, interval: float = 0, count: Optional[int] = None):
+        """
+        Polls until the CPU halts, at most `count` times if given.
+        The first retry follows immediately to catch quick halts such as after a step,
+        then the delay doubles from 0.1 ms up to `interval` (1 ms if not given).
+        """
+        delay = 0
         while not self.is_halted():
             if count is not None:
                 if count <= 1:
                     return False
                 else:
                     count -= 1
-            if interval:
-                time.sleep(interval)
+            if delay:
+                time.sleep(delay)
+            delay = min(delay * 2 or 0.0001, interval or 0.001)
         return True
     
     def reset(self):
         self.updi.store_csr(ASI_RESET_REQ, ASI_RSTREQ_RESET)
         self.updi.store_csr(ASI_RESET_REQ, ASI_RSTREQ_RUN)
-        while self.updi.load_csr(ASI_SYS_STATUS) & ASI_SYS_SYSRST:
-            time.sleep(0.01)
+        # OCD registers are not affected by a system reset, so the TRAPEN cache stays valid
+        self.updi.wait_csr(ASI_SYS_STATUS, ASI_SYS_SYSRST, 0, timeout=1.0)
         # For better compatibility with older devices
         time.sleep(0.1)
 
+    def get_traps(self) -> int:
+        if self.trapen is None:
+            self.trapen = self.updi.load_direct(OCD_TRAPEN, data_width=WIDTH_WORD)
+        return self.trapen
+
     def set_traps(self, traps: Traps):
         self.updi.store_direct(OCD_TRAPEN, traps, data_width=WIDTH_WORD)
+        self.trapen = int(traps)
 
     def enable_traps(self, traps: Traps):
-        current = self.updi.load_direct(OCD_TRAPEN, data_width=WIDTH_WORD)
-        self.updi.store_direct(OCD_TRAPEN, traps | current, data_width=WIDTH_WORD)
+        self.set_traps(self.get_traps() | traps)
 
     def disable_traps(self, traps: Traps):
-        current = self.updi.load_direct(OCD_TRAPEN, data_width=WIDTH_WORD)
-        self.updi.store_direct(OCD_TRAPEN, current & ~traps, data_width=WIDTH_WORD)
+        self.set_traps(self.get_traps() & ~traps)
     
     def set_bp(self, bpid: int, wordaddr: int):
-        byteaddr = (wordaddr << 1) & 0xFFFF
-        topbit = wordaddr >> 15
-        origregval = self.updi.load_direct(OCD_TRAPENH)
-        self.enable_traps(Traps.HWBP)
-        if bpid == 0:
-            self.updi.store_direct(OCD_BP0A, byteaddr, data_width=WIDTH_WORD)
-            self.updi.store_direct(OCD_BP0AT, topbit)
-            self.updi.store_direct(OCD_TRAPENH, origregval | 0x1)
-        elif bpid == 1:
-            self.updi.store_direct(OCD + 0x4, byteaddr, data_width=WIDTH_WORD)
-            self.updi.store_direct(OCD + 0x6, topbit)
-            self.updi.store_direct(OCD_TRAPENH, origregval | 0x2)
+        bpaddr = OCD_BP.pack((wordaddr << 1) & 0xFFFF, wordaddr >> 15)
+        with self.updi.pipeline():
+            # the address goes in first, then HWBP and the enable bit are set with one TRAPEN store
+            if bpid == 0:
+                self.updi.store_burst(OCD_BP0A, bpaddr, burst=OCD_BP.size)
+                self.enable_traps(Traps.HWBP | Traps.BP0)
+            elif bpid == 1:
+                self.updi.store_burst(OCD_BP1A, bpaddr, burst=OCD_BP.size)
+                self.enable_traps(Traps.HWBP | Traps.BP1)
 
     def clear_bp(self, bpid: int):
-        origregval = self.updi.load_direct(OCD_TRAPENH)
-        if bpid == 0:
-            self.updi.store_direct(OCD_TRAPENH, origregval & ~0x1)
-            self.updi.store_direct(OCD_BP0A, 0, data_width=WIDTH_WORD)
-            self.updi.store_direct(OCD_BP0AT, 0)
-        elif bpid == 1:
-            self.updi.store_direct(OCD_TRAPENH, origregval & ~0x2)
-            self.updi.store_direct(OCD + 0x4, 0, data_width=WIDTH_WORD)
-            self.updi.store_direct(OCD + 0x6, 0)
+        bpaddr = bytes(OCD_BP.size)
+        with self.updi.pipeline():
+            if bpid == 0:
+                self.disable_traps(Traps.BP0)
+                self.updi.store_burst(OCD_BP0A, bpaddr, burst=OCD_BP.size)
+            elif bpid == 1:
+                self.disable_traps(Traps.BP1)
+                self.updi.store_burst(OCD_BP1A, bpaddr, burst=OCD_BP.size)
 
     def get_pc(self):
         return self.updi.load_direct(OCD_PC, data_width=WIDTH_WORD)-1
@@ -161,62 +205,59 @@ class OcdRev1:
     def get_register_file(self):
         return self.updi.load_burst(OCD_R0, burst=32)
     
+    def get_cpu_state(self) -> Tuple[int, int, int, bytes]:
+        """
+        PC, SP, SREG and the register file, fetched with a single burst as they are contiguous from OCD_PC on.
+        PC is adjusted the same way as in get_pc.
+        """
+        dump = self.updi.load_burst(OCD_PC, burst=OCD_CPU.size + 32)
+        pc, sp, sreg = OCD_CPU.unpack_from(dump)
+        return pc - 1, sp, sreg, dump[OCD_CPU.size:]
+    
     def set_register_file(self, data:bytes):
         assert len(data)==32
         return self.updi.store_burst(OCD_R0, data, burst=32)
 
     def step(self):
-        origregval = self.updi.load_direct(OCD_TRAPENL)
-        self.updi.store_direct(OCD_TRAPENL, origregval | Traps.STEP)
-        self.run()
-        self.poll_halted()
-        self.updi.store_direct(OCD_TRAPENL, origregval)
+        # STEP stays enabled afterwards, so consecutive steps only resume and poll; run() and detach() clear it.
+        # Setting the trap and resuming go out with the first status poll.
+        with self.updi.pipeline():
+            if not self.get_traps() & Traps.STEP:
+                self.enable_traps(Traps.STEP)
+            self.updi.store_csr(ASI_OCD_CTRLA, ASI_OCD_RUN)
+            self.poll_halted()
     
-    def read_code(self, start:int, length:int) -> bytes:
+    def read_code(self, start:int, length:int) -> bytes | bytearray:
         if start < 0 or 0x200000 <= start or length <= 0:
             return bytes()
-        length = min(length, 256)
-        return self.updi.load_burst(start + self.flash_offset, burst=length)
+        # reads past 256 bytes continue from where the previous burst left the pointer
+        length = min(length, 0x200000 - start)
+        return self.updi.load_range(start + self.flash_offset, length)
     
-    def read_data(self, start:int, length:int) -> bytes:
+    def read_data(self, start:int, length:int) -> bytes | bytearray:
         if start < 0 or 0x10000 <= start or length <= 0:
             return bytes()
-        length = min(length, 256)
-        return self.updi.load_burst(start, burst=length)
+        length = min(length, 0x10000 - start)
+        return self.updi.load_range(start, length)
     
     def write_data(self, start: int, data: bytes):
-        if start < 0 or 0x10000 <= start or len(data) == 0 or len(data) > 256:
+        if start < 0 or 0x10000 < start + len(data) or len(data) == 0:
             return False
-        self.updi.store_burst(start, data, data_width=WIDTH_BYTE, burst=len(data))
+        # A burst covers at most 256 bytes; as stores have no response, all of them leave in a single transaction
+        with self.updi.pipeline(), memoryview(data) as view:
+            for offset in range(0, len(data), 256):
+                chunk = view[offset:offset + 256]
+                self.updi.store_burst(start + offset, chunk, data_width=WIDTH_BYTE, burst=len(chunk))
         return True
     
     def dump_ocd(self):
         dump = self.updi.load_burst(OCD, burst=64)
-        bp0 = dump[0] | (dump[1] << 8) | (dump[2] << 16)
-        bp1 = dump[4] | (dump[5] << 8) | (dump[6] << 16)
-        trapen = dump[8] | (dump[9] << 8)
-        trapstr = (("I" if trapen & Traps.INT else "_")
-                   + ("J" if trapen & Traps.JMP else "_")
-                   + ("S" if trapen & Traps.SWBP else "_")
-                   + ("X" if trapen & Traps.EXTBRK else "_")
-                   + ("1" if trapen & Traps.BP1 else "_")
-                   + ("0 " if trapen & Traps.BP0 else "_ ")
-                   + ("P" if trapen & Traps.STEP else "_")
-                   + ("H" if trapen & Traps.HWBP else "_")
-                   + ("?" if trapen & Traps.UNKNOWN1 else "_"))
-        cd = dump[12] | (dump[13] << 8)
+        bp0, bp0t, bp1, bp1t, trapen, cd, pc, sp, sreg = OCD_DUMP.unpack_from(dump)
+        bp0 |= bp0t << 16
+        bp1 |= bp1t << 16
+        trapstr = TRAPENH_FLAGS[trapen >> 8] + " " + TRAPENL_FLAGS[trapen & 0xFF]
         # o1011 = dump[0x10] | (dump[0x11] << 8)
-        pc = dump[0x14] | (dump[0x15] << 8)
-        sp = dump[0x18] | (dump[0x19] << 8)
-        sreg = dump[0x1c]
-        sregstr = (("I" if sreg & 0x80 else "i")
-                   + ("T" if sreg & 0x40 else "t")
-                   + ("H" if sreg & 0x20 else "h")
-                   + ("S" if sreg & 0x10 else "s")
-                   + ("V" if sreg & 0x08 else "v")
-                   + ("N" if sreg & 0x04 else "n")
-                   + ("Z" if sreg & 0x02 else "z")
-                   + ("C" if sreg & 0x01 else "c"))
+        sregstr = SREG_FLAGS[sreg]
         rf = dump[0x20:0x40].hex(",")
         print(f"BP0:\t 0x{bp0>>1:04x} W (0x{bp0:05x} B)")
         print(f"BP1:\t 0x{bp1>>1:04x} W (0x{bp1:05x} B)")
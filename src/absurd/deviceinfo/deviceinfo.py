@@ -1,10 +1,12 @@
 from dataclasses import dataclass
+from functools import lru_cache
 import re
 from typing import Tuple
 
 # TODO: NVM controller, signature, bootrow, etc...
 
-@dataclass
+# frozen, as get_deviceinfo hands out the same instance for repeated lookups
+@dataclass(frozen=True, slots=True)
 class DeviceInfo:
     flash_offset: int
     signature_addr: int
@@ -12,65 +14,46 @@ class DeviceInfo:
     flash_page_size: int
     eeprom_page_size: int
 
-megaavr = re.compile(r"atmega(?P<flash>8|16|32|48)0(?P<pincount>8|9)$")
-tinyavr = re.compile(r"attiny(?P<flash>2|4|8|16|32)(?P<series>0|1|2)(?P<pincount>2|4|6|7)$")
-newavr = re.compile(r"avr(?P<flash>16|32|64|128)(?P<series>da|db|dd|du|ea|eb)(?P<pincount>14|20|28|32|48|64)$")
+# One pattern for all supported parts; which named groups matched tells the product line apart
+partname_re = re.compile(r"atmega(?P<megaflash>8|16|32|48)0(?:8|9)$"
+                         r"|attiny(?P<tinyflash>2|4|8|16|32)(?:0|1|2)(?:2|4|6|7)$"
+                         r"|avr(?P<flash>16|32|64|128)(?P<family>da|db|dd|du|ea|eb)(?:14|20|28|32|48|64)$")
 
+# AVR Dx/Ex family: (signature_addr, flash_page_size, eeprom_page_size)
+NEWAVR_FAMILIES = {
+    "da": (0x1100, 512, 1),
+    "db": (0x1100, 512, 1),
+    "dd": (0x1100, 512, 1),
+    "du": (0x1080, 512, 1),
+    "ea": (0x1100, 64, 8),
+    "eb": (0x1080, 64, 8),
+}
+
+@lru_cache(maxsize=None)
 def get_deviceinfo(partname: str) -> DeviceInfo:
-    partname = partname.lower()
-    if m := megaavr.match(partname):
-        highdensity = int(m.group("flash")) >= 32
-        return DeviceInfo(
-            flash_offset=0x4000,
-            signature_addr=0x1100,
-            signature=(0x1E, 0x00, 0x00),
-            flash_page_size=128 if highdensity else 64,
-            eeprom_page_size=64 if highdensity else 32
-        )
+    m = partname_re.match(partname.lower())
+    if m is None:
+        raise ValueError
     
-    elif m := tinyavr.match(partname):
-        highdensity = int(m.group("flash")) >= 32
+    if family := m.group("family"):
+        signature_addr, flash_page_size, eeprom_page_size = NEWAVR_FAMILIES[family]
+        if family == "ea" and m.group("flash") == "64":
+            flash_page_size = 128
         return DeviceInfo(
-            flash_offset=0x8000,
-            signature_addr=0x1100,
+            flash_offset=0x800000,
+            signature_addr=signature_addr,
             signature=(0x1E, 0x00, 0x00),
-            flash_page_size=128 if highdensity else 64,
-            eeprom_page_size=64 if highdensity else 32
+            flash_page_size=flash_page_size,
+            eeprom_page_size=eeprom_page_size
         )
-
-    elif m := newavr.match(partname):
-        family = m.group("series")
-        if family in ("da", "db", "dd"):
-            return DeviceInfo(
-                flash_offset=0x800000,
-                signature_addr=0x1100,
-                signature=(0x1E, 0x00, 0x00),
-                flash_page_size=512,
-                eeprom_page_size=1
-            )
-        elif family in ("du"):
-            return DeviceInfo(
-                flash_offset=0x800000,
-                signature_addr=0x1080,
-                signature=(0x1E, 0x00, 0x00),
-                flash_page_size=512,
-                eeprom_page_size=1
-            )
-        elif family in ("ea"):
-            return DeviceInfo(
-                flash_offset=0x800000,
-                signature_addr=0x1100,
-                signature=(0x1E, 0x00, 0x00),
-                flash_page_size=128 if m.group("flash") == "64" else 64,
-                eeprom_page_size=8
-            )
-        elif family in ("eb"):
-            return DeviceInfo(
-                flash_offset=0x800000,
-                signature_addr=0x1080,
-                signature=(0x1E, 0x00, 0x00),
-                flash_page_size=64,
-                eeprom_page_size=8
-            )
-    raise ValueError
-
+    
+    # megaAVR 0-series and tinyAVR 0/1/2-series only differ in where flash is mapped
+    megaflash = m.group("megaflash")
+    highdensity = int(megaflash or m.group("tinyflash")) >= 32
+    return DeviceInfo(
+        flash_offset=0x4000 if megaflash else 0x8000,
+        signature_addr=0x1100,
+        signature=(0x1E, 0x00, 0x00),
+        flash_page_size=128 if highdensity else 64,
+        eeprom_page_size=64 if highdensity else 32
+    )
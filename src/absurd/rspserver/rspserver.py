@@ -1,9 +1,11 @@
 from ..debugger import OcdRev1, Traps
-import time
-import sys
+import binascii
+import re
+import struct
+import selectors
 import socket
-from typing import List, Literal, NoReturn
-from logging import getLogger
+from typing import List
+from logging import INFO, getLogger
 log = getLogger(__name__)
 
 # Signal codes for responses
@@ -19,6 +21,11 @@ ERR_READONLY = "E03"
 ERR_OUTOFHWBP = "E04"
 ERR_NOSUCHBP = "E05"
 
+# Largest packet payload GDB may send or expect, advertised in hex; '$', '#' and the checksum are not counted
+PACKET_SIZE = 0x1024
+# an `m` reply is hex-encoded, two characters per byte
+MAX_READ_LENGTH = PACKET_SIZE // 2
+
 # TODO: Memory type for the program memory should be "flash" with block size specified
 MEMORYMAP = """
 <?xml version="1.0"?>
@@ -29,23 +36,78 @@ MEMORYMAP = """
 </memory-map>
 """
 
+# SREG (1 B), SP (2 B) and byte PC (4 B) as laid out in the `g`/`G` register file
+REGISTERS_TAIL = struct.Struct("<BHI")
+
+# Monitor commands toggling traps: command -> (enable, traps, hex-encoded console output)
+MONITOR_TRAP_COMMANDS = {
+    cmd: (enable, traps, f"{msg}\n".encode("ascii").hex())
+    for cmd, enable, traps, msg in (
+        ("inttrap on", True, Traps.INT, "Interrupt trap enabled"),
+        ("inttrap off", False, Traps.INT, "Interrupt trap disabled"),
+        ("jmptrap on", True, Traps.JMP, "Jump trap enabled"),
+        ("jmptrap off", False, Traps.JMP, "Jump trap disabled"),
+        ("unk1 on", True, Traps.UNKNOWN1, "UNKNOWN1 enabled"),
+        ("unk1 off", False, Traps.UNKNOWN1, "UNKNOWN1 disabled"),
+        ("extbrk on", True, Traps.EXTBRK, "EXTBRK trap enabled"),
+        ("extbrk off", False, Traps.EXTBRK, "EXTBRK trap disabled"),
+    )
+}
+
+# Characters that must be escaped in outbound packets, mapped to their escape sequences ('}' followed by char ^ 0x20)
+ESCAPE_SEQUENCES = {b"}": b"}\x5d", b"#": b"}\x03", b"$": b"}\x04", b"*": b"}\x0a"}
+ESCAPE_PATTERN = re.compile(rb"[}#$*]")
+UNESCAPE_PATTERN = re.compile(rb"}(.)", re.DOTALL)
+
+# Complete packet; the checksum is validated separately
+PACKET_PATTERN = re.compile(rb"\$([^$#]*)#(..)", re.DOTALL)
+
+# Command name used for dispatch: the whole word for q/v packets, type for Z/z packets, otherwise the first character
+COMMAND_NAME = re.compile(r"[qv][A-Za-z]+|[Zz][0-4]|.", re.DOTALL)
+
 def verify_checksum(payload: bytes, checksum: bytes) -> bool:
     try:
-        calcdcs = sum(payload) % 256
-        recvdcs = int(checksum[:2].decode(encoding="ascii", errors="ignore"), 16)
-        return calcdcs == recvdcs
+        # int() parses the hex digits straight from bytes
+        return (sum(payload) & 0xFF) == int(checksum[:2], 16)
     except ValueError:
         return False
 
 
 def unescape(data: bytes) -> str:
-    parts = data.split(b'}')
-    ret = [parts[0].decode("ascii")]
-    for run in parts[1:]:
-        if len(run) > 0:
-            ret.append(chr(run[0] ^ 0x20))
-        ret.append(run[1:].decode("ascii"))
-    return "".join(ret)
+    # Escapes are rare, so the common case is a single decode
+    if b'}' not in data:
+        return data.decode("ascii")
+    return UNESCAPE_PATTERN.sub(lambda m: bytes((m.group(1)[0] ^ 0x20,)), data).decode("ascii")
+
+
+def escape(data: bytes) -> bytes:
+    # Single pass over the payload; most packets contain nothing to escape at all
+    return ESCAPE_PATTERN.sub(lambda m: ESCAPE_SEQUENCES[m.group()], data)
+
+
+def frame_packet(buf: bytearray, pos: int, data: str | bytes, needs_escape: bool = True) -> int:
+    """
+    Writes `data` framed as a packet into `buf` at `pos`, growing `buf` only if it is too short.
+    return: offset just past the written packet
+    """
+    # Packet is kept as bytes throughout; str payloads are encoded only once here
+    if isinstance(data, str):
+        data = data.encode("ascii")
+    # Hex-encoded payloads never contain characters to escape, leaving the checksum as the only pass over them
+    escaped = escape(data) if needs_escape else data
+    buf[pos:pos + 1] = b"$"
+    pos += 1
+    buf[pos:pos + len(escaped)] = escaped
+    pos += len(escaped)
+    # Checksum covers the escaped payload as transmitted
+    buf[pos:pos + 3] = b"#%02x" % (sum(escaped) & 0xFF)
+    return pos + 3
+
+
+def build_packet(data: str | bytes, needs_escape: bool = True) -> bytes:
+    buf = bytearray()
+    frame_packet(buf, 0, data, needs_escape)
+    return bytes(buf)
 
 
 def parse_addr(s: str):
@@ -60,31 +122,53 @@ def parse_addr(s: str):
 
 def decode_hex_array(s: str) -> bytes:
     try:
-        return bytes(int(s[2 * i:(2 * i + 2)], 16) for i in range(len(s) // 2))
+        # trailing odd nibble is ignored, as GDB never sends one
+        return bytes.fromhex(s[:len(s) & ~1])
     except ValueError:
         return bytes()
 
 
+# Replies sent over and over, framed once at import
+FRAMED_RESPONSES = {resp: build_packet(resp) for resp in ("", "OK", SIGTRAP, SIGINT, ERR_GENERAL, ERR_INVALIDARGS, ERR_ADDROUTOFRANGE, ERR_READONLY, ERR_OUTOFHWBP, ERR_NOSUCHBP)}
+
+
 class GdbPacketParser:
     def __init__(self) -> None:
-        self.pendingpacket: bytes = bytes()
+        # Unconsumed bytes; a pending packet, if any, always starts at offset 0
+        self.buf = bytearray()
+        # Offset in `buf` from which the pending packet has to be searched for '#'
+        self.scan_from = 0
 
-    def process_bytes(self, data: bytes) -> List[str]:
+    def process_bytes(self, data: bytes | memoryview) -> List[str]:
         if not data:
             return []
-        candidates = data.split(b'$')
-        candidates[0] = self.pendingpacket + candidates[0]
-        # check if the last is compelete separately
-        completepackets = [cand.split(b'#', 1) for cand in candidates[:-1] if b'#' in cand[:-2]]
-        if b'#' in candidates[-1][:-2]:
-            completepackets.append(candidates[-1].split(b'#', 1))
-            self.pendingpacket = bytes()
+        buf = self.buf
+        buf += data
+        if buf.find(b'#', self.scan_from) < 0:
+            # Nothing can complete before a '#' arrives; only resync to a retransmitted packet if there is one
+            start = buf.rfind(b'$', self.scan_from)
+            if start > 0:
+                del buf[:start]
+            elif start < 0 and not buf.startswith(b'$'):
+                # Nothing but ACKs and interrupts
+                buf.clear()
+            self.scan_from = len(buf)
+            return []
+        # The regex engine frames every complete packet in one pass, skipping ACKs, interrupts and abandoned packets
+        completepackets = [(bytes(payload), bytes(checksum)) for (payload, checksum) in PACKET_PATTERN.findall(buf)]
+        # Keep the last packet if it is still incomplete
+        start = buf.rfind(b'$')
+        if start >= 0 and not PACKET_PATTERN.match(buf, start):
+            del buf[:start]
         else:
-            self.pendingpacket = candidates[-1]
+            buf.clear()
+        # If its '#' already arrived, only the checksum is missing
+        end = buf.find(b'#')
+        self.scan_from = end if end >= 0 else len(buf)
         # ASCII-safety
-        checkedpackets = [(payload, checksum) for (payload, checksum) in completepackets if all(x < 0x80 for x in payload)]
-        # Unescape and verify checksum
-        unescapedpackets = [up for (payload, checksum) in checkedpackets if verify_checksum((up := unescape(payload)).encode("ascii"), checksum)]
+        checkedpackets = [(payload, checksum) for (payload, checksum) in completepackets if payload.isascii()]
+        # Verify checksum (calculated over the payload as transmitted) and unescape
+        unescapedpackets = [unescape(payload) for (payload, checksum) in checkedpackets if verify_checksum(payload, checksum)]
         return unescapedpackets
 
 
@@ -97,9 +181,20 @@ class RspServer:
         self.dbg = debugger
         self.packparser = GdbPacketParser()
         self.bps: List[int] = [-1, -1]
+        # Set while the '+' for the packet being handled has not been sent yet
+        self.ack_pending = False
+        # Receive buffer reused across reads
+        self.rxbuf = bytearray(65536)
+        self.rxview = memoryview(self.rxbuf)
+        # Transmit buffer reused across packets
+        self.txbuf = bytearray(4096)
+        # Set when a Ctrl-C arrives together with the packets of the same read; consumed by the continue it interrupts
+        self.interrupt_pending = False
+        # Waits for GDB input while the CPU is running
+        self.selector = selectors.DefaultSelector()
     
     def serve(self) -> None:
-        log.debug(f"Starting server; attaching to MCU and halting CPU")
+        log.debug("Starting server; attaching to MCU and halting CPU")
         self.dbg.attach()
         self.dbg.halt()
         self.dbg.set_traps(Traps.SWBP | Traps.HWBP)
@@ -114,324 +209,364 @@ class RspServer:
                 pass
 
         self.client = client
-        log.info(f"Connected with {addr}")
+        log.info("Connected with %s", addr)
         client.setblocking(True)
         client.settimeout(0.1)
+        # Replies are small and latency-bound; don't let Nagle hold them back
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.selector.register(client, selectors.EVENT_READ)
         try:
             while True:
                 try:
-                    data = self.client.recv(1024)
+                    n = self.client.recv_into(self.rxbuf)
                 except socket.timeout:
-                    data = bytes()
+                    n = 0
 
-                packets = self.packparser.process_bytes(data)
+                packets = self.packparser.process_bytes(self.rxview[:n])
 
-                if b'\x03' in data:
-                    log.info(f"Interrupted by GDB, halting CPU and sending SIGINT")
-                    client.sendall(b'+')
-                    self.dbg.halt()
-                    self.dbg.poll_halted()
-                    self.send_packet(SIGINT)
+                # The CPU is halted here; a Ctrl-C read along with a 'c' is answered by it without resuming
+                self.interrupt_pending = self.rxbuf.find(b'\x03', 0, n) >= 0
 
                 for p in packets:
-                    client.sendall(b'+')
-                    self.handle_packet(p)
+                    # The ACK goes out together with the reply, or on its own if the handler sends none
+                    self.ack_pending = True
+                    try:
+                        self.handle_packet(p)
+                    finally:
+                        self.send_ack()
+                # GDB still waits for a stop reply to any other Ctrl-C, even if the CPU had already stopped
+                if self.interrupt_pending:
+                    self.interrupt_pending = False
+                    log.info("Interrupted by GDB while halted, sending SIGINT")
+                    self.client.sendall(b'+')
+                    self.send_packet(SIGINT)
                 
         finally:
             self.dbg.detach()
+            self.selector.close()
             client.close()
             self.socket.close()
     
     def handle_packet(self, packet:str):
-        log.debug(f"Received Command: {packet}")
-
-        if packet.startswith("qSupported"):
-            log.debug(f"Responding to qSupported")
-            self.send_packet("PacketSize=1024;qXfer:memory-map:read+")
-
-        elif packet.startswith("qSymbol::"):
-            log.debug(f"Responding to qSymbol:: with OK")
-            self.send_packet("OK")
-            
-        elif packet.startswith("!"):
-            log.debug(f"Acknowledging extended-remote")
-            self.send_packet("OK")
-
-        elif packet.startswith("?"):
-            # we're on a baremetal 8-bitter (an excuse for hardcoding SIGTRAP)
-            log.debug(f"Responding to ? with SIGTRAP")
-            self.send_packet(SIGTRAP)
-
-        elif packet.startswith("s"):
-            # TODO: implement "step from..."
-            # step should halt the CPU immediately
-            log.debug(f"Stepping")
-            self.dbg.step()
-            self.send_packet(SIGTRAP)
-
-        elif packet.startswith("c"):
-            # TODO: implement "continue from..."
-            # We have to poll MCU for halted CPU, but we also have to accept interrupt request from GDB, so we poll both alternatingly
-            # This would help if PC was moved and pipeline was invalidated(?)
-            self.dbg.run()
-            log.info(f"Resumed CPU; now polling for CPU Halt or Client Interrupt")
-            while True:
-                if self.dbg.is_halted():
-                    log.info(f"CPU halted, sending SIGTRAP")
-                    self.send_packet(SIGTRAP)
-                    return
-                try:
-                    b = self.client.recv(1)
-                except socket.timeout:
-                    b = bytes()
-                # We assume we don't receive any packet here
-                if b'\x03' in b:
-                    log.info(f"Interrupted by GDB, halting CPU and sending SIGINT")
-                    self.client.sendall(b'+')
-                    self.dbg.halt()
-                    self.dbg.poll_halted()
-                    self.send_packet(SIGINT)
-                    return
-
-        elif packet.startswith("g"):
-            # General request for register file
-            # 64 chars for GPRs, 2 for SREG, 4 for SP, 8 for byte PC (78 in total)
-            log.debug(f"Responding to register file read request (g)")
-            gprs = self.dbg.get_register_file().hex()
-            sreg = self.dbg.get_sreg()
-            sp = self.dbg.get_sp()
-            pc = self.dbg.get_pc() << 1
-            sph = sp >> 8
-            spl = sp & 0xFF
-            pct = pc >> 16
-            pch = (pc >> 8) & 0xFF
-            pcl = pc & 0xFF
-            response = f"{gprs}{sreg:02x}{spl:02x}{sph:02x}{pcl:02x}{pch:02x}{pct:02x}00"
-            log.info(f"Register File: {response}")
-            self.send_packet(response)
-
-        elif packet.startswith("G"):
-            # General request for register write
-            # 64 chars for GPRs, 2 for SREG, 4 for SP, 8 for byte PC (78 in total)
-            log.debug(f"Responding to register file write request (G)")
-            data = decode_hex_array(packet[1:])
-            if len(data) != 39:
-                log.error(f"Invalid operand length")
-                self.send_packet(ERR_INVALIDARGS)
-                return
-            self.dbg.set_register_file(data[:32])
-            self.dbg.set_sreg(data[32])
-            self.dbg.set_sp(data[33] | (data[34] << 8))
-            pc = data[35] | (data[36] << 8) | (data[37] << 16)
-            pc >>= 1
-            # TODO: we may need to use move_pc if the PC is changed
-            self.dbg.set_pc(pc)
-            self.send_packet("OK")
-
-
-        elif packet.startswith("m"):
-            # Memory read access. Since modern AVRs map NVMs other than code flash to data space, we only support code (0x0-0x1FFFF) and data (0x800000-0x80FFFF)
-            log.debug(f"Responding to memory read request (m)")
-            addr, length = parse_addr(packet[1:])
-            if addr is None:
-                log.error(f"Could not parse command")
-                self.send_packet(ERR_INVALIDARGS)
-                return
-            
-            data = None
-            if 0 <= addr < 0x200000:
-                data = self.dbg.read_code(addr, length)
-                log.info(f"Code at 0x{addr:05x} (0x{addr >> 1:04x} W): {data.hex(' ')}")
-
-            elif 0x800000 <= addr < 0x810000:
-                data = self.dbg.read_data(addr - 0x800000, length)
-                log.info(f"Data at 0x{addr - 0x800000:04x}: {data.hex(' ')}")
-            
-            if data:
-                self.send_packet(data.hex())
-            else:
-                log.error(f"Address out of valid range")
-                self.send_packet(ERR_ADDROUTOFRANGE)   
-
-        elif packet.startswith("M"):
-            # Memory write access. Only data (0x800000-0x80FFFF) supported.
-            log.debug(f"Responding to memory write request (M)")
-            cmd = packet[1:].split(":")
-            if len(cmd) != 2:
-                log.error(f"Could not parse command")
-                self.send_packet(ERR_INVALIDARGS)
+        log.debug("Received Command: %s", packet)
+        name = m.group() if (m := COMMAND_NAME.match(packet)) else ""
+        self.HANDLERS.get(name, RspServer.handle_unknown)(self, packet)
+
+    def handle_qsupported(self, packet: str):
+        log.debug("Responding to qSupported")
+        self.send_packet(f"PacketSize={PACKET_SIZE:x};qXfer:memory-map:read+")
+
+    def handle_qsymbol(self, packet: str):
+        log.debug("Responding to qSymbol with OK")
+        self.send_packet("OK")
+
+    def handle_extended_mode(self, packet: str):
+        log.debug("Acknowledging extended-remote")
+        self.send_packet("OK")
+
+    def handle_halt_reason(self, packet: str):
+        # we're on a baremetal 8-bitter (an excuse for hardcoding SIGTRAP)
+        log.debug("Responding to ? with SIGTRAP")
+        self.send_packet(SIGTRAP)
+
+    def handle_step(self, packet: str):
+        # TODO: implement "step from..."
+        # step should halt the CPU immediately
+        log.debug("Stepping")
+        self.dbg.step()
+        self.send_packet(SIGTRAP)
+
+    def handle_continue(self, packet: str):
+        # TODO: implement "continue from..."
+        # We have to poll MCU for halted CPU, but we also have to accept interrupt request from GDB, so we poll both alternatingly
+        # This would help if PC was moved and pipeline was invalidated(?)
+        # GDB must not wait for the ACK until the CPU halts
+        self.send_ack()
+        if self.interrupt_pending:
+            # Ctrl-C came in the same read as this packet; answer it without resuming at all
+            self.interrupt_pending = False
+            log.info("Interrupted by GDB before resuming, sending SIGINT")
+            self.client.sendall(b'+')
+            self.send_packet(SIGINT)
+            return
+        self.dbg.run()
+        log.info("Resumed CPU; now polling for CPU Halt or Client Interrupt")
+        while True:
+            if self.dbg.is_halted():
+                log.info("CPU halted, sending SIGTRAP")
+                self.send_packet(SIGTRAP)
                 return
-             
-            addr, length = parse_addr(cmd[0])
-            data = decode_hex_array(cmd[1])
-
-            if addr is None or len(data) != length:
-                log.error(f"Could not parse command")
-                self.send_packet(ERR_INVALIDARGS)
-                return
-            elif not (0x800000 <= addr < 0x810000):
-                log.error(f"Address out of valid range")
-                self.send_packet(ERR_ADDROUTOFRANGE)
-
-            if self.dbg.write_data(addr-0x800000, data):
-                log.info(f"Data at 0x{addr - 0x800000:04x}: {data.hex(' ')}")
-                self.send_packet("OK")
-            else:
-                log.error(f"Data write failed")
-                self.send_packet(ERR_INVALIDARGS)
-        # TODO: temporarily fake SWBP
-        elif packet.startswith("Z1") or packet.startswith("Z0"):
-            # Set hardware BP
-            log.debug(f"Responding to HWBP set request (Z1)")
-            cmd = packet[3:].split(",")[0]
-            try:
-                addr = int(cmd, 16)
-            except ValueError:
-                log.error(f"Could not parse command")
-                self.send_packet(ERR_INVALIDARGS)
+            # The MCU can only be polled, so wait on the socket just briefly before checking it again
+            if not self.selector.select(timeout=0.01):
+                continue
+            b = self.client.recv(1)
+            # We assume we don't receive any packet here
+            if b'\x03' in b:
+                log.info("Interrupted by GDB, halting CPU and sending SIGINT")
+                self.client.sendall(b'+')
+                self.dbg.halt()
+                self.dbg.poll_halted()
+                self.send_packet(SIGINT)
                 return
-            
-            if self.bps[0] < 0:
-                self.bps[0] = addr
-                log.info(f"Setting BP0 to 0x{addr:05x} (0x{addr >> 1:04x} W)")
-                self.dbg.set_bp(0, addr >> 1)
-                self.send_packet("OK")
-            elif self.bps[1] < 0:
-                self.bps[1] = addr
-                log.info(f"Setting BP1 to 0x{addr:05x} (0x{addr >> 1:04x} W)")
-                self.dbg.set_bp(1, addr >> 1)
-                self.send_packet("OK")
-            else:
-                log.error(f"No free HW BPs")
-                self.send_packet(ERR_OUTOFHWBP)
 
-        elif packet.startswith("z1") or packet.startswith("z0"):
-            # Clear hardware BP
-            log.debug(f"Responding to HWBP clear request (z1)")
-            cmd = packet[3:].split(",")[0]
-            try:
-                addr = int(cmd, 16)
-            except ValueError:
-                log.error(f"Could not parse command")
-                self.send_packet(ERR_INVALIDARGS)
-                return
-            
-            if self.bps[0] == addr:
-                self.bps[0] = -1
-                log.info(f"Clearing BP0 at 0x{addr:05x}")
-                self.dbg.clear_bp(0)
-                self.send_packet("OK")
-            elif self.bps[1] == addr:
-                self.bps[1] = -1
-                log.info(f"Clearing BP1 at 0x{addr:05x}")
-                self.dbg.clear_bp(1)
-                self.send_packet("OK")
-            else:
-                log.error(f"No such HW BPs")
-                self.send_packet(ERR_NOSUCHBP)
+    def handle_read_registers(self, packet: str):
+        # General request for register file
+        # 64 chars for GPRs, 2 for SREG, 4 for SP, 8 for byte PC (78 in total)
+        log.debug("Responding to register file read request (g)")
+        pc, sp, sreg, gprs = self.dbg.get_cpu_state()
+        pc <<= 1
+        # SREG, SP and PC follow the GPRs in little endian; encoded to hex in one go together with them
+        regs = gprs + REGISTERS_TAIL.pack(sreg, sp, pc & 0xFFFFFF)
+        if log.isEnabledFor(INFO):
+            log.info("Register File: %s", regs.hex(' '))
+        self.send_packet(binascii.hexlify(regs), needs_escape=False)
+
+    def handle_write_registers(self, packet: str):
+        # General request for register write
+        # 64 chars for GPRs, 2 for SREG, 4 for SP, 8 for byte PC (78 in total)
+        log.debug("Responding to register file write request (G)")
+        data = decode_hex_array(packet[1:])
+        if len(data) != 39:
+            log.error("Invalid operand length")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+        self.dbg.set_register_file(data[:32])
+        self.dbg.set_sreg(data[32])
+        self.dbg.set_sp(data[33] | (data[34] << 8))
+        pc = data[35] | (data[36] << 8) | (data[37] << 16)
+        pc >>= 1
+        # TODO: we may need to use move_pc if the PC is changed
+        self.dbg.set_pc(pc)
+        self.send_packet("OK")
+
+    def handle_read_memory(self, packet: str):
+        # Memory read access. Since modern AVRs map NVMs other than code flash to data space, we only support code (0x0-0x1FFFF) and data (0x800000-0x80FFFF)
+        log.debug("Responding to memory read request (m)")
+        addr, length = parse_addr(packet[1:])
+        if addr is None:
+            log.error("Could not parse command")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+        # GDB splits larger reads itself; anything beyond the reply size would only be UPDI traffic thrown away
+        length = min(length, MAX_READ_LENGTH)
         
+        data = None
+        if 0 <= addr < 0x200000:
+            data = self.dbg.read_code(addr, length)
+            if log.isEnabledFor(INFO):
+                log.info("Code at 0x%05x (0x%04x W): %s", addr, addr >> 1, data.hex(' '))
+
+        elif 0x800000 <= addr < 0x810000:
+            data = self.dbg.read_data(addr - 0x800000, length)
+            if log.isEnabledFor(INFO):
+                log.info("Data at 0x%04x: %s", addr - 0x800000, data.hex(' '))
         
-        elif packet.startswith("z0") or packet.startswith("Z0"):
-            log.debug(f"Responding to SWBP request (z0)")
-            self.send_packet(ERR_GENERAL)
-
-        elif packet.startswith("vAttach"):
-            log.info(f"Responding to vAttach with fake SIGTRAP")
-            self.send_packet(SIGTRAP)
-
-        elif packet.startswith("qXfer:memory-map:read"):
-            log.info(f"qXfer:memory-map:read::")
-            try:
-                offset, length = packet[23:].split(",")
-                offset = int(offset, 16)
-                length = int(length, 16)
-            except (ValueError, IndexError):
-                log.error(f"Could not parse command")
-                self.send_packet(ERR_INVALIDARGS)
-                return
-            if offset+length >= len(MEMORYMAP):
-                self.send_packet("l" + MEMORYMAP[offset:(offset+length)])
-            else:
-                self.send_packet("m" + MEMORYMAP[offset:(offset+length)])
-
-        elif packet.startswith("qRcmd"):
-            # would be a good place to support strange things
-            log.info(f"Monitor Command: {packet}")
-            cmd = decode_hex_array(packet[6:]).decode(errors="ignore")
-            if cmd=="reset":
-                log.info(f"Resetting MCU")
-                self.dbg.reset()
-                self.send_packet("OK")
-            elif cmd=="inttrap on":
-                log.info(f"Enabling interrupt trap")
-                self.dbg.enable_traps(Traps.INT)
-                self.send_packet(b'Interrupt trap enabled\n'.hex())
-            elif cmd=="inttrap off":
-                log.info(f"Disabling interrupt trap")
-                self.dbg.disable_traps(Traps.INT)
-                self.send_packet(b'Interrupt trap disabled\n'.hex())
-            elif cmd=="jmptrap on":
-                log.info(f"Enabling jump trap")
-                self.dbg.enable_traps(Traps.JMP)
-                self.send_packet(b'Jump trap enabled\n'.hex())
-            elif cmd=="jmptrap off":
-                log.info(f"Disabling jump trap")
-                self.dbg.disable_traps(Traps.JMP)
-                self.send_packet(b'Jump trap disabled\n'.hex())
-            elif cmd=="unk1 on":
-                log.info(f"Enabling UNKNOWN1")
-                self.dbg.enable_traps(Traps.UNKNOWN1)
-                self.send_packet(b'UNKNOWN1 enabled\n'.hex())
-            elif cmd=="unk1 off":
-                log.info(f"Disabling UNKNOWN1")
-                self.dbg.disable_traps(Traps.UNKNOWN1)
-                self.send_packet(b'UNKNOWN1 disabled\n'.hex())
-            elif cmd=="extbrk on":
-                log.info(f"Enabling EXTBRK trap")
-                self.dbg.enable_traps(Traps.EXTBRK)
-                self.send_packet(b'EXTBRK trap enabled\n'.hex())
-            elif cmd=="extbrk off":
-                log.info(f"Disabling EXTBRK trap")
-                self.dbg.disable_traps(Traps.EXTBRK)
-                self.send_packet(b'EXTBRK trap disabled\n'.hex())
-            else:
-                log.warn(f"Unrecognized monitor command")
-                self.send_packet("")
-
-        elif packet.startswith("k"):
-            log.info(f"Ignoring k command...")
+        if data:
+            self.send_packet(binascii.hexlify(data), needs_escape=False)
+        else:
+            log.error("Address out of valid range")
+            self.send_packet(ERR_ADDROUTOFRANGE)   
+
+    def handle_write_memory(self, packet: str):
+        # Memory write access. Only data (0x800000-0x80FFFF) supported.
+        log.debug("Responding to memory write request (M)")
+        cmd = packet[1:].split(":")
+        if len(cmd) != 2:
+            log.error("Could not parse command")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+         
+        addr, length = parse_addr(cmd[0])
+        data = decode_hex_array(cmd[1])
+
+        if addr is None or len(data) != length:
+            log.error("Could not parse command")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+        elif not (0x800000 <= addr < 0x810000):
+            log.error("Address out of valid range")
+            self.send_packet(ERR_ADDROUTOFRANGE)
+            return
+
+        if self.dbg.write_data(addr-0x800000, data):
+            if log.isEnabledFor(INFO):
+                log.info("Data at 0x%04x: %s", addr - 0x800000, data.hex(' '))
+            self.send_packet("OK")
+        else:
+            log.error("Data write failed")
+            self.send_packet(ERR_INVALIDARGS)
 
-        elif packet.startswith("vKill"):
-            log.info(f"Responding to vKill with fake OK...")
+    def handle_set_bp(self, packet: str):
+        # Set hardware BP
+        log.debug("Responding to HWBP set request (Z1)")
+        cmd = packet[3:].split(",")[0]
+        try:
+            addr = int(cmd, 16)
+        except ValueError:
+            log.error("Could not parse command")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+        
+        if self.bps[0] < 0:
+            self.bps[0] = addr
+            log.info("Setting BP0 to 0x%05x (0x%04x W)", addr, addr >> 1)
+            self.dbg.set_bp(0, addr >> 1)
             self.send_packet("OK")
-            log.info(f"Detaching")
-            raise StopIteration() # TODO: stop abuse of StopIteration
+        elif self.bps[1] < 0:
+            self.bps[1] = addr
+            log.info("Setting BP1 to 0x%05x (0x%04x W)", addr, addr >> 1)
+            self.dbg.set_bp(1, addr >> 1)
+            self.send_packet("OK")
+        else:
+            log.error("No free HW BPs")
+            self.send_packet(ERR_OUTOFHWBP)
 
-        elif packet.startswith("vRun"):
-            log.info(f"Resetting MCU upon vRun request")
+    def handle_clear_bp(self, packet: str):
+        # Clear hardware BP
+        log.debug("Responding to HWBP clear request (z1)")
+        cmd = packet[3:].split(",")[0]
+        try:
+            addr = int(cmd, 16)
+        except ValueError:
+            log.error("Could not parse command")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+        
+        if self.bps[0] == addr:
+            self.bps[0] = -1
+            log.info("Clearing BP0 at 0x%05x", addr)
+            self.dbg.clear_bp(0)
+            self.send_packet("OK")
+        elif self.bps[1] == addr:
+            self.bps[1] = -1
+            log.info("Clearing BP1 at 0x%05x", addr)
+            self.dbg.clear_bp(1)
+            self.send_packet("OK")
+        else:
+            log.error("No such HW BPs")
+            self.send_packet(ERR_NOSUCHBP)
+
+    def handle_vattach(self, packet: str):
+        log.info("Responding to vAttach with fake SIGTRAP")
+        self.send_packet(SIGTRAP)
+
+    def handle_qxfer(self, packet: str):
+        if not packet.startswith("qXfer:memory-map:read"):
+            self.handle_unknown(packet)
+            return
+        log.info("qXfer:memory-map:read::")
+        try:
+            offset, length = packet[23:].split(",")
+            offset = int(offset, 16)
+            length = int(length, 16)
+        except (ValueError, IndexError):
+            log.error("Could not parse command")
+            self.send_packet(ERR_INVALIDARGS)
+            return
+        if offset+length >= len(MEMORYMAP):
+            self.send_packet("l" + MEMORYMAP[offset:(offset+length)])
+        else:
+            self.send_packet("m" + MEMORYMAP[offset:(offset+length)])
+
+    def handle_monitor(self, packet: str):
+        # would be a good place to support strange things
+        log.info("Monitor Command: %s", packet)
+        cmd = decode_hex_array(packet[6:]).decode(errors="ignore")
+        if cmd=="reset":
+            log.info("Resetting MCU")
             self.dbg.reset()
-            self.send_packet(SIGTRAP)
-
-        elif packet.startswith("R") or packet.startswith("r"):
-            log.info(f"Resetting MCU upon R/r request")
-            self.dbg.reset()  
-
-        elif packet.startswith("T") or packet.startswith("H"):
-            log.info(f"Responding to thread-related command with fake OK...")
             self.send_packet("OK")
-
-        elif packet.startswith("D"):
-            log.info(f"Detaching")
-            raise StopIteration() # TODO: stop abuse of StopIteration
-
+        elif trapcmd := MONITOR_TRAP_COMMANDS.get(cmd):
+            enable, traps, reply = trapcmd
+            log.info("%s traps 0x%04x", "Enabling" if enable else "Disabling", traps)
+            if enable:
+                self.dbg.enable_traps(traps)
+            else:
+                self.dbg.disable_traps(traps)
+            self.send_packet(reply, needs_escape=False)
         else:
-            log.warn(f"Unknown Command: {packet}")
+            log.warning("Unrecognized monitor command")
             self.send_packet("")
-    
 
-    def send_packet(self, data: str):
-        checksum = f"{sum(data.encode('ascii')) % 256:02x}"
-        escaped = data.replace("}", "}\x5d").replace("#","}\x03").replace("$","}\x04").replace("*","}\x0a")
-        pack = f"${escaped}#{checksum}".encode("ascii")
-        self.client.sendall(pack)
+    def handle_kill(self, packet: str):
+        log.info("Ignoring k command...")
+
+    def handle_vkill(self, packet: str):
+        log.info("Responding to vKill with fake OK...")
+        self.send_packet("OK")
+        log.info("Detaching")
+        raise StopIteration() # TODO: stop abuse of StopIteration
+
+    def handle_vrun(self, packet: str):
+        log.info("Resetting MCU upon vRun request")
+        self.dbg.reset()
+        self.send_packet(SIGTRAP)
+
+    def handle_reset(self, packet: str):
+        log.info("Resetting MCU upon R/r request")
+        self.dbg.reset()  
+
+    def handle_thread(self, packet: str):
+        log.info("Responding to thread-related command with fake OK...")
+        self.send_packet("OK")
+
+    def handle_detach(self, packet: str):
+        log.info("Detaching")
+        raise StopIteration() # TODO: stop abuse of StopIteration
+
+    def handle_unknown(self, packet: str):
+        log.warning("Unknown Command: %s", packet)
+        self.send_packet("")
+
+    # Handlers keyed by command name as extracted by COMMAND_NAME
+    HANDLERS = {
+        "qSupported": handle_qsupported,
+        "qSymbol": handle_qsymbol,
+        "qXfer": handle_qxfer,
+        "qRcmd": handle_monitor,
+        "!": handle_extended_mode,
+        "?": handle_halt_reason,
+        "s": handle_step,
+        "c": handle_continue,
+        "g": handle_read_registers,
+        "G": handle_write_registers,
+        "m": handle_read_memory,
+        "M": handle_write_memory,
+        # TODO: temporarily fake SWBP
+        "Z0": handle_set_bp,
+        "Z1": handle_set_bp,
+        "z0": handle_clear_bp,
+        "z1": handle_clear_bp,
+        "vAttach": handle_vattach,
+        "vKill": handle_vkill,
+        "vRun": handle_vrun,
+        "k": handle_kill,
+        "R": handle_reset,
+        "r": handle_reset,
+        "T": handle_thread,
+        "H": handle_thread,
+        "D": handle_detach,
+    }
+
+    def send_ack(self):
+        if self.ack_pending:
+            self.ack_pending = False
+            self.client.sendall(b'+')
+
+    def send_packet(self, data: str | bytes, needs_escape: bool = True):
+        # The ACK (if still pending) and the packet are assembled in the reusable transmit buffer
+        buf = self.txbuf
+        pos = 0
+        if self.ack_pending:
+            self.ack_pending = False
+            buf[0:1] = b'+'
+            pos = 1
+        if (framed := FRAMED_RESPONSES.get(data)) is not None:
+            end = pos + len(framed)
+            buf[pos:end] = framed
+        else:
+            end = frame_packet(buf, pos, data, needs_escape)
+        # No view of the buffer outlives the call, so it can still grow for an oversized packet later
+        with memoryview(buf) as view:
+            self.client.sendall(view[:end])
 
@@ -1,4 +1,4 @@
-from .updirev3 import UpdiRev3, UpdiException
+from .updirev3 import UpdiRev3, UpdiException, UPDI_CTRLA
 from .updicompat import UpdiRev1, UpdiRev2
 
 UpdiClient = UpdiRev1 | UpdiRev2 | UpdiRev3
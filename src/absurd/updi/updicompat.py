@@ -1,33 +1,14 @@
-from typing import Literal, Optional, Tuple
+from typing import Literal
 from .updirev3 import UpdiRev3
 
 
 class UpdiRev2(UpdiRev3):
-    def load_indirect(self, data_width: Literal[0, 1] = 0, addr_step: Literal[0, 1] = 1, burst=1) -> bytes:
-        """
-        `ld *ptr` instruction (opcode 0x2_)
-        loads data at the address pointed by the pointer.
-        data_width: (0=B; 1=W)
-        addr_step: (0=No change, 1=post-increment)
-        burst: number of bytes/words stored in burst (must match the operand of preceding `repeat` instruction)
-        return: bytes for both `data_width`s (low byte first to match memory layout)
-        """
-        return super().load_indirect(data_width, addr_step, burst)
-
-    def store_indirect(self, data: bytes, data_width: Literal[0, 1] = 0, addr_step: Literal[0, 1] = 1, burst=1) -> None:
-        """
-        `st *ptr` instruction (opcode 0x6_)
-        stores `data` at the address pointed by the pointer.
-        data_width: (0=B; 1=W)
-        addr_step: (0=No change, 1=post-increment)
-        burst: number of bytes/words stored in burst (must match the operand of preceding `repeat` instruction)
-        """
-        super().store_indirect(data, data_width, addr_step, burst)
+    """
+    UPDI client for revision 2, which lacks post-decrement (`addr_step`=3) of `ld`/`st *ptr`.
+    The instruction set is otherwise the same, so the revision 3 methods are used as they are.
+    """
 
 
-class UpdiRev4(UpdiRev2):
-    pass
-
 class UpdiRev1(UpdiRev2):
     def load_pointer(self, addr_width: Literal[0, 1] = 1) -> int:
         """
@@ -66,3 +47,27 @@ class UpdiRev1(UpdiRev2):
         """
         assert addr_width in (0, 1)
         super().store_direct(addr, data, addr_width, data_width)
+
+    def load_burst(self, addr: int, data_width: Literal[0, 1] = 0, burst=1, addr_width: Literal[0, 1] = 1) -> bytes:
+        """
+        burst indirect load using successive `st ptr`, `repeat` and `ld *ptr++` instructions.
+        addr_width: address width of `st ptr` (0=B; 1=W)
+        """
+        assert addr_width in (0, 1)
+        return super().load_burst(addr, data_width, burst, addr_width)
+
+    def load_range(self, addr: int, nbytes: int, addr_width: Literal[0, 1] = 1) -> bytearray:
+        """
+        contiguous load of `nbytes` using `st ptr` once, then `repeat` and `ld *ptr++` per 256 bytes.
+        addr_width: address width of `st ptr` (0=B; 1=W)
+        """
+        assert addr_width in (0, 1)
+        return super().load_range(addr, nbytes, addr_width)
+
+    def store_burst(self, addr: int, data: bytes, data_width: Literal[0, 1] = 0, burst=1, addr_width: Literal[0, 1] = 1) -> None:
+        """
+        burst indirect store using successive `st ptr`, `repeat` and `st *ptr++` instructions.
+        addr_width: address width of `st ptr` (0=B; 1=W)
+        """
+        assert addr_width in (0, 1)
+        super().store_burst(addr, data, data_width, burst, addr_width)
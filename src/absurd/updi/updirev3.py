@@ -1,9 +1,45 @@
+import os
+import sys
+import select
 import time
-from typing import Tuple, Literal
-from logging import getLogger
+import struct
+from contextlib import contextmanager
+from typing import Iterator, Tuple, Literal
+from logging import INFO, getLogger
 log = getLogger(__name__)
 import serial
 
+# UPDI control/status registers used by the client itself
+UPDI_CTRLA = 0x2
+UPDI_CTRLA_RSD = 0x08   # Response Signature Disable: suppresses ACKs of `st`/`sts`
+
+# UART frame: start bit, 8 data bits, even parity and 2 stop bits
+BITS_PER_CHAR = 12
+
+# Instruction encodings, indexed by address width (0=B; 1=W; 2=3B) or CS address
+LDS_OPCODES = (0x00, 0x04, 0x08)
+STS_OPCODES = (0x40, 0x44, 0x48)
+STPTR_OPCODES = (0x68, 0x69, 0x6A)
+# `ld`/`st` opcodes, indexed by (pointer access << 2) | width
+LD_OPCODES = tuple(bytes((0x20 | mode,)) for mode in range(16))
+ST_OPCODES = tuple(bytes((0x60 | mode,)) for mode in range(16))
+LDCS_OPCODES = tuple(bytes((0x80 | addr,)) for addr in range(16))
+SIB_OPCODES = tuple(bytes((0xE4 | size,)) for size in range(4))
+# `repeat` with its operand, indexed by count - 1
+REPEAT_INSTRUCTIONS = tuple(bytes((0xA0, count)) for count in range(256))
+# opcode followed by a little-endian address; 3-byte addresses are packed as 4 bytes and truncated
+ADDRESS_FORMATS = (struct.Struct("<BB"), struct.Struct("<BH"), struct.Struct("<BI"))
+DATA_FORMATS = (struct.Struct("<B"), struct.Struct("<H"))
+# largest value representable in each address/data width, for argument checks
+ADDR_MAX = (0xFF, 0xFFFF, 0xFFFFFF)
+DATA_MAX = (0xFF, 0xFFFF)
+
+def pack_address(opcode: int, addr: int, addr_width: int) -> bytes:
+    """
+    `opcode` followed by `addr` in `addr_width` (0=B; 1=W; 2=3B)
+    """
+    return ADDRESS_FORMATS[addr_width].pack(opcode, addr)[:addr_width + 2]
+
 class UpdiException(Exception):
     def __init__(self, instruction:str, *args: object) -> None:
         super().__init__(*args)
@@ -12,14 +48,32 @@ class UpdiException(Exception):
 class UpdiRev3:
     """
     UPDI client as specified in AVR EA's datasheet (revision 3)
+
+    `ld *ptr` and `st *ptr` (`load_indirect`, `load_indirect_words`, `store_indirect`) take the burst length
+    and issue the `repeat` instruction themselves, in the same transaction; they must not be preceded by `repeat()`.
     """
 
     def __init__(self, serialport:str, baudrate:int, updi_prescaler=0):
         self.uart = serial.Serial(baudrate=115200, parity=serial.PARITY_EVEN, stopbits=serial.STOPBITS_TWO, timeout=1.0)
         self.uart.port = serialport
         self.uart.dtr = False
+        # bound once, as they are called for every instruction
+        self.uart_write = self.uart.write
+        self.uart_read = self.uart.read
         self.baudrate = baudrate
         self.updi_prescaler = updi_prescaler
+        self.shadow_ctrla(0)
+        # outgoing frames are assembled here, so that multi-part instructions are not concatenated piece by piece
+        self.txbuf = bytearray(4096)
+        # inside `pipeline()`, number of bytes of deferred instructions waiting at the head of `txbuf`
+        self.pipelining = 0
+        self.pending = 0
+        # set after a failed transaction, whose leftovers must not be taken for the next echo
+        self.resync = False
+        # direct access to the port's file descriptor, where the platform allows it (see `receive`)
+        self.fd = None
+        self.poller = None
+        self.rxbuf = bytearray(4096)
     
     def connect(self) -> int:
         """
@@ -29,12 +83,54 @@ class UpdiRev3:
         # there's no spec for how long HV has to be kept asserted, but 1 ms sounds long enough
         log.debug("Opening serial port")
         self.uart.dtr = False
+        # the port stays open when connecting again after a failed attempt and `resynchronize`
+        if not self.uart.is_open:
+            try:
+                self.uart.open()
+            except serial.SerialException:
+                log.error("Could not open %s", self.uart.name)
+                raise
+
+        # USB-serial adapters otherwise hold back short replies until their latency timer expires (16 ms on FTDI)
         try:
-            self.uart.open()
-        except serial.SerialException:
-            log.error(f"Could not open {self.uart.name}")
-            raise
+            self.uart.set_low_latency_mode(True)
+        except (AttributeError, ValueError):
+            # Some drivers reject ASYNC_LOW_LATENCY but still expose the timer of usb-serial devices through sysfs
+            try:
+                with open(f"/sys/bus/usb-serial/devices/{os.path.basename(self.uart.port)}/latency_timer", "w") as timer:
+                    timer.write("1")
+            except OSError:
+                log.debug("Low-latency mode is not available on this port")
+        # poll() is only dependable on Linux ttys; macOS reports POLLNVAL for them
+        try:
+            if not sys.platform.startswith("linux"):
+                raise AttributeError(sys.platform)
+            self.fd = self.uart.fileno()
+            self.poller = select.poll()
+            self.poller.register(self.fd, select.POLLIN)
+        except (AttributeError, OSError, serial.SerialException):
+            self.fd = None
+            log.debug("Polling the file descriptor is not supported; falling back to pyserial reads")
         
+        # Most devices accept Sync well before the 13 ms limit, so a short delay is tried first and the full one only if that fails
+        try:
+            version = self.handshake(0.001)
+        except UpdiException as ex:
+            log.info("No response after a 1 ms handshake delay (%s); resynchronizing and retrying with the full delay", ex)
+            # the failed attempt may have left UPDI in an error state; if UPDI was never enabled, the break gets no reply
+            try:
+                self.resynchronize()
+            except UpdiException:
+                log.debug("No response to break; UPDI is probably not enabled yet")
+            version = self.handshake(0.005)
+        log.info("UPDI version: %d", version >> 4)
+        return version >> 4
+    
+    def handshake(self, delay: float) -> int:
+        """
+        Emits HV pulse and handshake, waits `delay` seconds before the first instruction, then sets up CTRLB and the prescaler.
+        returns: STATUSA, read to confirm communication
+        """
         log.debug("Emitting HV pulse and handshake")
         time.sleep(0.001)
         self.uart.dtr = True
@@ -46,7 +142,10 @@ class UpdiRev3:
         self.uart.write(b'\x00')
         self.uart.flush()
         # We have 13 ms before sending Sync char
-        time.sleep(0.005)
+        time.sleep(delay)
+        # discard the echo of the handshake; commands do not clear the input buffer themselves
+        self.uart.reset_input_buffer()
+        self.resync = False
         
         # Added for compatibility with T412
         # stcs CTRLB, 0x08 (Disable contention check)
@@ -60,8 +159,7 @@ class UpdiRev3:
 
         # Check successful communication by `ldcs STATUSA`
         version = self.load_csr(0x00)
-        log.info(f"UPDI version: {version >> 4}")
-        return version >> 4
+        return version
     
     def disconnect(self):
         """
@@ -70,6 +168,7 @@ class UpdiRev3:
         if self.uart.is_open:
             self.store_csr(0x3, 4)
             self.uart.close()
+            self.fd = None
 
     def resynchronize(self) -> int:
         """
@@ -82,6 +181,8 @@ class UpdiRev3:
         # On request, CH340 changes baudrate immediately, even during active transmission
         # Because of this, we have to send NUL at a very low baudrate, sleep a while, then restore the original rate to simulate a break
         params = self.uart.get_settings()
+        # deferred instructions would be sent into the break, so they are given up
+        self.pending = 0
         self.uart.baudrate = 300
         self.uart.write(b"\0\0")
         self.uart.flush()
@@ -90,13 +191,14 @@ class UpdiRev3:
         log.debug("Clearing PESIG by read access")
         self.uart.baudrate = 115200
         self.uart.reset_input_buffer()
+        self.resync = False
         self.uart.write(b'U\x81')
         self.uart.flush()
-        buffer = self.uart.read(3)
+        buffer = self.receive(3)
         if len(buffer) != 3:
-            log.error(f"'ldcs STATUSB' after Break timed out; could not connect to MCU (expected 3 bytes, got '{buffer.hex(' ')}')")
+            log.error("'ldcs STATUSB' after Break timed out; could not connect to MCU (expected 3 bytes, got '%s')", buffer.hex(' '))
             raise UpdiException("ldcs", "`ldcs STATUSB` following a BREAK character failed")
-        log.info(f"UPDI resynchronized; error code: {buffer[2]:02x}")
+        log.info("UPDI resynchronized; error code: %02x", buffer[2])
         # Set prescaler and resume full baudrate
         self.store_csr(0x09, self.updi_prescaler & 0x03)
         time.sleep(0.001)
@@ -104,44 +206,164 @@ class UpdiRev3:
 
         return buffer[2]
     
-    def command(self, txdata: bytes, n_expected=0, skip_sync=False) -> Tuple[bool, bytes]:
+    def receive(self, n: int) -> bytes:
+        """
+        Reads `n` bytes, returning fewer only if they have not arrived by the deadline:
+        the port timeout on top of the time the transfer itself takes at the current baud rate.
+        On POSIX the port is polled and read directly, which takes one wakeup per burst of incoming bytes
+        instead of going through pyserial's read loop.
+        """
+        monotonic = time.monotonic
+        deadline = monotonic() + self.uart.timeout + n * BITS_PER_CHAR / self.uart.baudrate
+        if self.fd is None:
+            # pyserial may return short when its own timeout runs out mid-transfer
+            buffer = self.uart_read(n)
+            while len(buffer) < n and monotonic() < deadline:
+                buffer += self.uart_read(n - len(buffer))
+            return buffer
+        if n > len(self.rxbuf):
+            self.rxbuf = bytearray(n)
+        fd, poll = self.fd, self.poller.poll
+        got = 0
+        with memoryview(self.rxbuf) as view:
+            while got < n:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                events = poll(timeout * 1000)
+                if not events:
+                    break
+                if events[0][1] & (select.POLLERR | select.POLLNVAL):
+                    raise serial.SerialException(f"{self.uart.name} reported an error while reading")
+                try:
+                    count = os.readv(fd, (view[got:n],))
+                except BlockingIOError:
+                    # spurious wakeup
+                    continue
+                except OSError as ex:
+                    # e.g. EIO once the adapter is unplugged
+                    raise serial.SerialException(f"read failed: {ex}") from ex
+                if count == 0:
+                    break
+                got += count
+            return bytes(view[:got])
+    
+    def transmit(self, data: memoryview):
+        """
+        Writes `data` to the port. On POSIX it goes straight to the file descriptor,
+        skipping pyserial's copy of the buffer and its write-timeout bookkeeping.
+        """
+        if self.fd is None:
+            self.uart_write(data)
+            return
+        # pyserial opens the port non-blocking, so a full TX queue shows up as EAGAIN rather than a short write
+        sent, n = 0, len(data)
+        while sent < n:
+            try:
+                sent += os.write(self.fd, data[sent:])
+            except BlockingIOError:
+                select.select((), (self.fd,), ())
+            except OSError as ex:
+                raise serial.SerialException(f"write failed: {ex}") from ex
+    
+    def drain_on_error(self):
+        """
+        Clears the input buffer after a failed transaction, and again before the next one is sent,
+        since the rest of a late response may still be arriving in between.
+        """
+        self.uart.reset_input_buffer()
+        self.resync = True
+    
+    def command(self, *txdata: bytes, n_expected=0, skip_sync=False) -> Tuple[bool, bytes]:
         """
         Transmit `txdata` and wait for reception of `n_expected` bytes.
+        `txdata` may be given in several parts, which are sent back to back as one frame.
         Sync character ('U') is automatically prepended to `txdata` unless `skip_sync` is set
         """
-        n_tx = len(txdata) if skip_sync else len(txdata) + 1
-        self.uart.reset_input_buffer()
-        log.info(f"Command: {txdata.hex(' ')} -> {n_expected} B")
-        if skip_sync:
-            self.uart.write(txdata)
+        if self.resync:
+            self.uart.reset_input_buffer()
+            self.resync = False
+        buf = self.txbuf
+        start = n_tx = self.pending
+        if not skip_sync:
+            buf[n_tx:n_tx + 1] = b'U'
+            n_tx += 1
+        for part in txdata:
+            end = n_tx + len(part)
+            buf[n_tx:end] = part
+            n_tx = end
+        deferred = self.pipelining and n_expected == 0
+        if deferred:
+            # nothing to wait for: keep it in the buffer and send it along with the next instruction
+            self.pending = n_tx
         else:
-            self.uart.write(b'U' + txdata)
-        self.uart.flush()
+            self.pending = 0
+            with memoryview(buf) as view:
+                self.transmit(view[:n_tx])
+        # Logging is done once the frame is on its way, so that it overlaps with transmission rather than delaying it.
+        # Hex dumps are only built when they are going to be emitted.
+        if log.isEnabledFor(INFO):
+            log.info("Command: %s -> %d B", buf[start + 1 - skip_sync:n_tx].hex(' '), n_expected)
+        if deferred:
+            return True, bytes()
         
-        echo = self.uart.read(n_tx)
-        # log.debug(f"command echo: {echo}")
-        if len(echo) != n_tx:
-            log.error(f"Instruction echo not received (expected {n_tx} byte(s), got '{echo.hex(' ')}')")
+        # no need to drain TX first: every byte is echoed, so the read below cannot complete before transmission does
+        # echo and response arrive back to back, so both are collected by one read
+        buffer = self.receive(n_tx + n_expected)
+        if len(buffer) < n_tx:
+            log.error("Instruction echo not received (expected %d byte(s), got '%s')", n_tx, buffer.hex(' '))
+            self.drain_on_error()
             return False, b"E"
+        # With RSD set, the echo is all there is to confirm stores; one comparison covers the whole frame
+        with memoryview(buf) as view:
+            echoed = buffer.startswith(view[:n_tx])
+        if not echoed:
+            log.error("Instruction echo does not match (sent '%s', got '%s')", buf[:n_tx].hex(' '), buffer[:n_tx].hex(' '))
+            self.drain_on_error()
+            return False, b"E"
+        if len(buffer) != n_tx + n_expected:
+            log.error("Expected response not received (expected %d byte(s), got '%s')", n_expected, buffer[n_tx:].hex(' '))
+            self.drain_on_error()
+            return False, b"R"
         
         if n_expected == 0:
             return True, bytes()
-        
-        buffer = self.uart.read(n_expected)
-        # log.debug(f"command return: {buffer}")
-        if len(buffer) != n_expected:
-            log.error(f"Expected response not received (expected {n_expected} byte(s), got '{buffer.hex(' ')}')")
-            return False, b"R"
-        log.info(f"Response: {buffer.hex(' ')}")
+        buffer = buffer[n_tx:]
+        if log.isEnabledFor(INFO):
+            log.info("Response: %s", buffer.hex(' '))
         return True, buffer
     
+    @contextmanager
+    def pipeline(self) -> Iterator["UpdiRev3"]:
+        """
+        Within this context, instructions without response (`stcs`, `sts`, `st`, `repeat`, `key`) are not sent immediately,
+        but together with the next instruction that has one, or at the end of the block.
+        A deferred instruction that fails is reported by the instruction it was sent with.
+        Stores are made with RSD set, so only the device's answers to later instructions show that it took them:
+        if the block ends with deferred instructions, CTRLA is read back along with them.
+        """
+        self.pipelining += 1
+        try:
+            yield self
+        except BaseException:
+            self.pending = 0
+            raise
+        finally:
+            self.pipelining -= 1
+        if not self.pipelining and self.pending:
+            # The echo comes from the adapter's own loopback; a response is needed to know the device is there and in sync
+            succ, val = self.command(LDCS_OPCODES[UPDI_CTRLA], n_expected=1)
+            if not succ or val[0] != self.ctrla:
+                log.error("pipeline read-back of CTRLA failed: %s", val)
+                raise UpdiException("pipeline", "deferred instructions were not confirmed by the device")
+    
 
     def load_csr(self, addr: int) -> int:
         """
         `ldcs addr` instruction (opcode 0x8_)
         """
         assert 0 <= addr <= 0xF
-        succ, val = self.command(bytes((0x80 | addr, )), n_expected=1)
+        succ, val = self.command(LDCS_OPCODES[addr], n_expected=1)
         if not succ:
             raise UpdiException("ldcs")
         return val[0]
@@ -156,8 +378,37 @@ class UpdiRev3:
         succ, val = self.command(bytes((0xC0 | addr, value)))
         if not succ:
             raise UpdiException("stcs")
+        if addr == UPDI_CTRLA:
+            self.shadow_ctrla(value)
         
     
+    def wait_csr(self, addr: int, mask: int, value: int, timeout: float = 0.2) -> bool:
+        """
+        Polls CS register `addr` until its bits in `mask` read as `value`, instead of sleeping for a worst-case delay.
+        The interval starts at 1 ms and backs off to 5 ms.
+        return: False if `timeout` (seconds) elapsed first
+        """
+        deadline = time.monotonic() + timeout
+        interval = 0.001
+        while self.load_csr(addr) & mask != value:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, 0.005)
+        return True
+    
+    
+    def shadow_ctrla(self, value: int):
+        """
+        Keeps a copy of CTRLA, so that RSD can be toggled without disturbing the other bits.
+        The `stcs` frames that set and restore RSD around a store are encoded here once, rather than on every store:
+        `rsd_enter` ends with the sync character of the wrapped instruction, `rsd_exit` begins with its own.
+        """
+        self.ctrla = value
+        self.rsd_enter = bytes((0xC0 | UPDI_CTRLA, value | UPDI_CTRLA_RSD, 0x55))
+        self.rsd_exit = bytes((0x55, 0xC0 | UPDI_CTRLA, value))
+    
+    
     def read_sib(self, size: Literal[0b00, 0b01, 0b10] = 2) -> bytes:
         """
         `key.sib width` instruction (opcode 0xE_)  
@@ -165,7 +416,7 @@ class UpdiRev3:
         * width=2 is undocumented, but is used by official debuggers, and in fact 32 B is sent even if width=1
         """
         assert 0 <= size <= 3
-        succ, val = self.command(bytes((0xE4 | size,)), n_expected=32)
+        succ, val = self.command(SIB_OPCODES[size], n_expected=32)
         if not succ:
             raise UpdiException("sib")
         return val 
@@ -177,7 +428,7 @@ class UpdiRev3:
         The keys are ASCII strings available as consts.
         """
         assert len(key) == 8
-        succ, val = self.command(bytes((0xE0,)) + key[::-1])
+        succ, val = self.command(b'\xE0', key[::-1])
         if not succ:
             raise UpdiException("key")
         
@@ -186,9 +437,10 @@ class UpdiRev3:
         """
         `repeat count` instruction. (opcode 0xA0)
         * count can be byte or word, but it is limited to 255, so the word-width variant is not so meaningful
+        * bursts of `ld`/`st *ptr` issue their own `repeat`; this is only for composing other instruction sequences
         """
         assert 1<=count<=0x100
-        succ, val = self.command(bytes((0xA0, count-1)))
+        succ, val = self.command(REPEAT_INSTRUCTIONS[count - 1])
         if not succ:
             raise UpdiException("repeat")
         
@@ -200,22 +452,14 @@ class UpdiRev3:
         data_width: data width (0=B; 1=W)  
         * prefixing with `repeat` is supported by hardware, but omitted from this library
         """
-        assert (addr_width==0 and 0<=addr<=0xFF) or (addr_width==1 and 0<=addr<=0xFFFF) or (addr_width==2 and 0<=addr<=0xFFFFFF)
+        assert 0 <= addr <= ADDR_MAX[addr_width]
         assert 0 <= data_width <= 1
-        if addr_width==0:
-            succ, val = self.command(bytes((0x00 | data_width, addr)), n_expected=data_width + 1)
-        elif addr_width==1:
-            succ, val = self.command(bytes((0x04 | data_width, addr & 0xFF, addr >> 8)), n_expected=data_width + 1)
-        else:
-            succ, val = self.command(bytes((0x08 | data_width, addr & 0xFF, (addr >> 8) & 0xFF, addr >> 16)), n_expected=data_width + 1)
+        succ, val = self.command(pack_address(LDS_OPCODES[addr_width] | data_width, addr, addr_width), n_expected=data_width + 1)
 
-        if succ and data_width==0:
-            return val[0] 
-        elif succ:
-            return (val[1] << 8) | val[0]  
-        else:
+        if not succ:
             log.error("lds instruction failed")
             raise UpdiException("lds")
+        return int.from_bytes(val, 'little')
         
     
     def store_direct(self, addr:int, data:int, addr_width:Literal[0,1,2]=2, data_width:Literal[0,1]=0) -> None:
@@ -225,23 +469,26 @@ class UpdiRev3:
         data_width: data width (0=B; 1=W)  
         * prefixing with `repeat` is supported by hardware, but omitted from this library
         """
-        assert (addr_width==0 and 0<=addr<=0xFF) or (addr_width==1 and 0<=addr<=0xFFFF) or (addr_width==2 and 0<=addr<=0xFFFFFF)
-        assert (data_width==0 and 0<=data<=0xFF) or (data_width==1 and 0<=data<=0xFFFF)
+        assert 0 <= addr <= ADDR_MAX[addr_width]
+        assert 0 <= data <= DATA_MAX[data_width]
 
-        if addr_width==0:
-            succ, val = self.command(bytes((0x40 | data_width, addr)), n_expected=1)
-        elif addr_width==1:
-            succ, val = self.command(bytes((0x44 | data_width, addr & 0xFF, addr >> 8)), n_expected=1)
-        else:
-            succ, val = self.command(bytes((0x48 | data_width, addr & 0xFF, (addr >> 8) & 0xFF, addr >> 16)), n_expected=1)
-        if not succ or val[0]!=0x40:
-            log.error(f"sts instruction failed at addressing stage: {val}")
+        if self.pipelining:
+            # With RSD set there is no ACK to wait for, so the whole instruction can be deferred;
+            # the pipeline ends with a read-back that shows whether the device took it
+            succ, val = self.command(self.rsd_enter, pack_address(STS_OPCODES[addr_width] | data_width, addr, addr_width),
+                                     DATA_FORMATS[data_width].pack(data), self.rsd_exit)
+            if not succ:
+                log.error("sts instruction failed: %s", val)
+                raise UpdiException("sts", "`sts` instruction did not receive own echo")
+            return
+        # Data may only follow the address once its ACK has been received
+        succ, val = self.command(pack_address(STS_OPCODES[addr_width] | data_width, addr, addr_width), n_expected=1)
+        if not succ or val[0] != 0x40:
+            log.error("sts instruction failed in address stage: %s", val)
             raise UpdiException("sts", "`sts` instruction did not receive ACK in address stage")
-
-        databytes = bytes((data,)) if data_width==0 else bytes((data & 0xFF, data >> 8))
-        succ, val = self.command(databytes, n_expected=1, skip_sync=True)
-        if not succ or val[0]!=0x40:
-            log.error(f"sts instruction failed at data stage: {val}")
+        succ, val = self.command(DATA_FORMATS[data_width].pack(data), n_expected=1, skip_sync=True)
+        if not succ or val[0] != 0x40:
+            log.error("sts instruction failed in data stage: %s", val)
             raise UpdiException("sts", "`sts` instruction did not receive ACK in data stage")
 
 
@@ -251,16 +498,10 @@ class UpdiRev3:
         reads the pointer for indirect access by `ld`/`st` instructions.
         addr_width: address width (0=B; 1=W; 2=3B)
         """
-        succ, val = self.command(bytes((0x28 | addr_width,)), n_expected=1 + addr_width)
+        succ, val = self.command(LD_OPCODES[0x8 | addr_width], n_expected=1 + addr_width)
         if not succ:
             raise UpdiException("ld", "`ld ptr`")
-        
-        if addr_width == 0:
-            return val[0]
-        elif addr_width == 1:
-            return val[0] | (val[1] << 8)
-        else:
-            return val[0] | (val[1] << 8) | (val[2] << 16)
+        return int.from_bytes(val, 'little')
         
         
     def store_pointer(self, addr:int, addr_width:Literal[0,1,2]=2) -> None:
@@ -269,16 +510,18 @@ class UpdiRev3:
         sets the pointer for indirect access by `ld`/`st` instructions.
         addr_width: address width (0=B; 1=W; 2=3B)
         """
-        assert (addr_width==0 and 0<=addr<=0xFF) or (addr_width==1 and 0<=addr<=0xFFFF) or (addr_width==2 and 0<=addr<=0xFFFFFF)
+        assert 0 <= addr <= ADDR_MAX[addr_width]
 
-        if addr_width==0:
-            succ, val = self.command(bytes((0x68, addr)), n_expected=1)
-        elif addr_width==1:
-            succ, val = self.command(bytes((0x69, addr & 0xFF, addr >> 8)), n_expected=1)
-        else:
-            succ, val = self.command(bytes((0x6A, addr & 0xFF, (addr >> 8) & 0xFF, addr >> 16)), n_expected=1)
+        if self.pipelining:
+            # without the ACK, the instruction can be deferred and sent along with whatever uses the pointer
+            succ, val = self.command(self.rsd_enter, pack_address(STPTR_OPCODES[addr_width], addr, addr_width), self.rsd_exit)
+            if not succ:
+                log.error("st ptr instruction failed: %s", val)
+                raise UpdiException("st", "`st ptr`")
+            return
+        succ, val = self.command(pack_address(STPTR_OPCODES[addr_width], addr, addr_width), n_expected=1)
         if not succ or val[0]!=0x40:
-            log.error(f"st ptr instruction failed: {val}")
+            log.error("st ptr instruction failed: %s", val)
             raise UpdiException("st", "`st ptr`")
         
     
@@ -288,51 +531,122 @@ class UpdiRev3:
         loads data at the address pointed by the pointer.
         data_width: (0=B; 1=W)
         addr_step: (0=No change, 1=post-increment, 3=post-decrement)
-        burst: number of bytes/words stored in burst (must match the operand of preceding `repeat` instruction)
+        burst: number of bytes/words loaded in burst; the `repeat` instruction is issued here, not by the caller
         return: bytes for both `data_width`s (low byte first to match memory layout)
         """
-        succ, val = self.command(bytes((0x20 | (addr_step << 2) | data_width,)), n_expected=burst * (data_width + 1))
+        assert 1 <= burst <= 0x100
+        n_data = burst * (data_width + 1)
+        if burst > 1:
+            succ, val = self.command(REPEAT_INSTRUCTIONS[burst - 1], b'U', LD_OPCODES[(addr_step << 2) | data_width], n_expected=n_data)
+        else:
+            succ, val = self.command(LD_OPCODES[(addr_step << 2) | data_width], n_expected=n_data)
         if not succ:
             raise UpdiException("ld", f"`ld` expected {burst} {['byte','word'][data_width]}(s)")
         return val 
 
+    def load_indirect_words(self, addr_step:Literal[0,1,3]=1, burst=1) -> Tuple[int, ...]:
+        """
+        `ld *ptr` instruction (opcode 0x2_) with word width, decoded into integers.
+        addr_step: (0=No change, 1=post-increment, 3=post-decrement)
+        burst: number of words loaded in burst; the `repeat` instruction is issued by `load_indirect`
+        """
+        return struct.unpack(f"<{burst}H", self.load_indirect(data_width=1, addr_step=addr_step, burst=burst))
+
     def store_indirect(self, data: bytes, data_width:Literal[0,1]=0, addr_step:Literal[0,1,3]=1, burst=1) -> None:
         """
         `st *ptr` instruction (opcode 0x6_)
-        stores `data` at the address pointed by the pointer.
+        stores `data` (any bytes-like object; it is not copied before framing) at the address pointed by the pointer.
         data_width: (0=B; 1=W)
         addr_step: (0=No change, 1=post-increment, 3=post-decrement)
-        burst: number of bytes/words stored in burst (must match the operand of preceding `repeat` instruction)
-        """
-        assert len(data) >= (burst if data_width == 0 else 2 * burst)
-        assert 1 <= burst <= 0xFF
-        succ, val = self.command(bytes((0x60 | (addr_step << 2) | data_width,)))
-        if not succ:
-            log.error(f"st *ptr instruction failed in instruction stage: {val}")
-            raise UpdiException("st", f"`st` did not receive own echo in instruction stage")
+        burst: number of bytes/words stored in burst; the `repeat` instruction is issued here, not by the caller
+        """
+        n_data = burst * (data_width + 1)
+        assert len(data) >= n_data
+        assert 1 <= burst <= 0x100
+        if not self.store_elements((), ST_OPCODES[(addr_step << 2) | data_width], memoryview(data), burst, data_width + 1):
+            log.error("st *ptr instruction failed")
+            raise UpdiException("st", f"`st` did not receive own echo or ACK")
 
-        for i in range(burst):
-            if data_width == 0:
-                succ, val = self.command(bytes((data[i],)), n_expected=1, skip_sync=True)
+    def store_elements(self, head: Tuple[bytes, ...], opcode: bytes, data: memoryview, burst: int, width: int) -> bool:
+        """
+        Sends the instructions in `head`, then `st *ptr` (`opcode`) of `burst` elements of `width` bytes from `data`.
+        The line is half-duplex, so the elements can only be sent back to back if the device does not answer each with ACK:
+        RSD is set around them and restored in the same transaction. `repeat` only applies to the instruction right after it,
+        so it comes after the `stcs` that sets RSD.
+        Within a pipeline all of it is deferred. Otherwise the last element is stored separately with RSD cleared,
+        since the echo comes from the adapter itself and only the device's ACK confirms that the stores reached it.
+        return: whether the echo, and the ACK where expected, were received
+        """
+        n_rsd = burst if self.pipelining else burst - 1
+        parts = []
+        if head or n_rsd:
+            parts.append(self.rsd_enter)
+            for instruction in head:
+                parts += (instruction, b'U')
+            if n_rsd > 1:
+                parts += (REPEAT_INSTRUCTIONS[n_rsd - 1], b'U')
+            if n_rsd:
+                parts += (opcode, data[:n_rsd * width])
             else:
-                succ, val = self.command(bytes((data[2 * i], data[2 * i + 1])), n_expected=1, skip_sync=True)
+                # `rsd_exit` brings its own sync character
+                parts.pop()
+            parts.append(self.rsd_exit)
+        if self.pipelining:
+            succ, val = self.command(*parts)
+            return succ
+        if parts:
+            parts.append(b'U')
+        parts += (opcode, data[n_rsd * width:burst * width])
+        succ, val = self.command(*parts, n_expected=1)
+        return succ and val[0] == 0x40
 
-            if not succ or val[0]!=0x40:
-                log.error(f"st *ptr instruction failed in data stage: {val}")
-                raise UpdiException("st", f"`st` did not receive enough bytes in data stage")
-
-    def load_burst(self, addr: int, data_width: Literal[0, 1] = 0, burst=1) -> bytes:
+    def load_burst(self, addr: int, data_width: Literal[0, 1] = 0, burst=1, addr_width: Literal[0, 1, 2] = 2) -> bytes:
         """
         burst indirect load using successive `st ptr`, `repeat` and `ld *ptr++` instructions.
+        All three are sent in one transaction; `st ptr` is executed with RSD set so that its ACK does not interfere.
         """
-        self.store_pointer(addr)
-        self.repeat(burst)
-        return self.load_indirect(data_width=data_width, addr_step=1, burst=burst)
+        assert 0 <= addr <= ADDR_MAX[addr_width]
+        assert 1 <= burst <= 0x100
+        succ, val = self.command(self.rsd_enter, pack_address(STPTR_OPCODES[addr_width], addr, addr_width), self.rsd_exit,
+                                 b'U', REPEAT_INSTRUCTIONS[burst - 1], b'U', LD_OPCODES[0x4 | data_width],
+                                 n_expected=burst * (data_width + 1))
+        if not succ:
+            raise UpdiException("ld", f"`ld` expected {burst} {['byte','word'][data_width]}(s)")
+        return val
+    
+    def load_range(self, addr: int, nbytes: int, addr_width: Literal[0, 1, 2] = 2) -> bytearray:
+        """
+        Reads `nbytes` contiguous bytes in bursts of up to 256.
+        The pointer is only set for the first burst; the following ones continue from where `ld *ptr++` left it,
+        so each of them is a single `repeat` and `ld *ptr++` transaction.
+        A burst's data has to be received before the next instruction can be sent, hence one transaction per burst.
+        The bursts are placed in a buffer allocated once, which is handed to the caller without another copy.
+        """
+        assert nbytes >= 1
+        buffer = bytearray(nbytes)
+        burst = min(nbytes, 0x100)
+        buffer[:burst] = self.load_burst(addr, burst=burst, addr_width=addr_width)
+        offset = burst
+        while offset < nbytes:
+            burst = min(nbytes - offset, 0x100)
+            succ, val = self.command(REPEAT_INSTRUCTIONS[burst - 1], b'U', LD_OPCODES[0x4], n_expected=burst)
+            if not succ:
+                raise UpdiException("ld", f"`ld` expected {burst} byte(s)")
+            buffer[offset:offset + burst] = val
+            offset += burst
+        return buffer
     
-    def store_burst(self, addr: int, data: bytes, data_width: Literal[0, 1] = 0, burst=1) -> None:
+    def store_burst(self, addr: int, data: bytes, data_width: Literal[0, 1] = 0, burst=1, addr_width: Literal[0, 1, 2] = 2) -> None:
         """
         burst indirect store using successive `st ptr`, `repeat` and `st *ptr++` instructions.
-        """
-        self.store_pointer(addr)
-        self.repeat(burst)
-        self.store_indirect(data, data_width=data_width, addr_step=1, burst=burst)
+        All three are sent in one transaction with RSD set; outside a pipeline the last element is stored with RSD cleared,
+        so that the device's ACK confirms the store (see `store_elements`).
+        """
+        assert 0 <= addr <= ADDR_MAX[addr_width]
+        n_data = burst * (data_width + 1)
+        assert len(data) >= n_data
+        assert 1 <= burst <= 0x100
+        if not self.store_elements((pack_address(STPTR_OPCODES[addr_width], addr, addr_width),), ST_OPCODES[0x4 | data_width],
+                                   memoryview(data), burst, data_width + 1):
+            log.error("burst store failed")
+            raise UpdiException("st", f"`st` did not receive own echo or ACK")